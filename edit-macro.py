@@ -36,13 +36,13 @@
 """
 
 import argparse
-import difflib
 import enum
-import http.server
+import html
+import json
 import logging
 import os
 import pathlib
-import pprint
+import shlex
 import shutil
 import sqlite3
 import subprocess
@@ -51,10 +51,8 @@ import tempfile
 import textwrap
 import time
 import typing
-import urllib
-import webbrowser
 
-from keycodes import keycodes_by_value, keycodes_by_name
+from keycodes import keycodes_by_value, keycodes_by_name, NAME_BY_VALUE, VALUE_BY_NAME
 
 class ObinsKitMacroItemKey(enum.Enum):
     """
@@ -79,6 +77,19 @@ class ObinsKitMacroItemKey(enum.Enum):
     def to_int(self) -> int:
         return int(self.value)
 
+# Maps the raw int key from macro_value to its enum member, bypassing Enum.__call__
+_BY_INT = {m.value: m for m in ObinsKitMacroItemKey}
+
+# Maps the (canonical, upper-case) key token of a macro event line to its enum member
+_KEY_DISPATCH = {
+    "KEY_UP": ObinsKitMacroItemKey.KEY_UP,
+    "KEY_DOWN": ObinsKitMacroItemKey.KEY_DOWN,
+    "WAIT": ObinsKitMacroItemKey.WAIT,
+}
+
+# Pre-formatted, padded name of each key, as written in the human-editable file
+_KEY_NAME_STR = {k: f"{k.name:<8}" for k in ObinsKitMacroItemKey}
+
 class ObinsKitMacroItemTuple(typing.NamedTuple):
     key: ObinsKitMacroItemKey
     value_2: int
@@ -86,68 +97,130 @@ class ObinsKitMacroItemTuple(typing.NamedTuple):
 
     def __repr__(self) -> str:
         """Detailed string repr of an ObinsKitMacroItemTuple used for debugging."""
-        s = f'ObinsKitMacroItemTuple: key={ObinsKitMacroItemKey(self.key):8}'
-        if ObinsKitMacroItemKey(self.key) in [ObinsKitMacroItemKey.KEY_UP, ObinsKitMacroItemKey.KEY_DOWN]:
-            s += f' value_2={self.value_2:3} (keycode={keycodes_by_value[self.value_2]["name"]})'
+        k = self.key if isinstance(self.key, ObinsKitMacroItemKey) else _BY_INT[self.key]
+        s = f'ObinsKitMacroItemTuple: key={_KEY_NAME_STR[k]}'
+        if k is not ObinsKitMacroItemKey.WAIT:
+            s += f' value_2={self.value_2:3} (keycode={self.keycode_name()})'
         else:
             s += f' value_2={self.value_2:3} value_3={self.value_3:3} (wait={self.value_2 + self.value_3 * 256})'
         return s
 
     def __str__(self) -> str:
         """Simple string repr of an ObinsKitMacroItemTuple used in human-editable file."""
-        s = f'{ObinsKitMacroItemKey(self.key):8}'
-        if ObinsKitMacroItemKey(self.key) in [ObinsKitMacroItemKey.KEY_UP, ObinsKitMacroItemKey.KEY_DOWN]:
-            s += f' {keycodes_by_value[self.value_2]["name"]}'
+        k = self.key if isinstance(self.key, ObinsKitMacroItemKey) else _BY_INT[self.key]
+        s = _KEY_NAME_STR[k]
+        if k is not ObinsKitMacroItemKey.WAIT:
+            s += f' {self.keycode_name()}'
         else:
             s += f' {self.value_2 + self.value_3 * 256}'
         return s
 
+    def keycode_name(self) -> str:
+        """Name of the keycode in value_2 of a KEY_* event, raising KeyError if it is not in the keycodes maps."""
+        name = NAME_BY_VALUE[self.value_2] if 0 <= self.value_2 < len(NAME_BY_VALUE) else None
+        if name is None:
+            raise KeyError(f"Macro event contains keycode {self.value_2}"
+                f" which is not in keycodes maps! See keycodes.py for details.")
+        return name
+
     def from_str(strepr):
         """Convert a string repr of an ObinsKitMacroItemTuple to an ObinsKitMacroItemTuple."""
-        logger.debug(f"from_str: '{strepr.strip()}'")
+        logger.debug("from_str: '%s'", strepr.strip())
         key, value = strepr.strip().split()
-        if key.upper() in ["KEY_UP", "KEY_DOWN"] and value not in keycodes_by_name.keys():
+        if key not in _KEY_DISPATCH:
+            raise KeyError(f"Macro Event Line \"{strepr}\" contains key \"{key}\""
+                f" which is not a valid macro event key! Must be one of: {', '.join(_KEY_DISPATCH.keys())}.")
+        enum_key = _KEY_DISPATCH[key]
+        if enum_key is ObinsKitMacroItemKey.WAIT:
+            # Nothing to validate for waits, time can be any value
+            return ObinsKitMacroItemTuple(enum_key, int(value), 0)
+        if value not in VALUE_BY_NAME:
             raise KeyError(f"Macro Event Line \"{strepr}\" contains value \"{value}\""
                 f" which is not in keycodes maps! Must be one of: {', '.join(list(keycodes_by_name.keys()))}."
                 f" See keycodes.py for details.")
-        if key.upper() == "KEY_UP":
-            return ObinsKitMacroItemTuple(ObinsKitMacroItemKey.KEY_UP, keycodes_by_name[value]['value'], 0)
-        elif key.upper() == "KEY_DOWN":
-            return ObinsKitMacroItemTuple(ObinsKitMacroItemKey.KEY_DOWN, keycodes_by_name[value]['value'], 0)
-        elif key.upper() == "WAIT":
-            # Nothing to validate for waits, time can be any value
-            return ObinsKitMacroItemTuple(ObinsKitMacroItemKey.WAIT, int(value), 0)
+        return ObinsKitMacroItemTuple(enum_key, VALUE_BY_NAME[value], 0)
 
     def to_int_macro_value_list(self):
         """Convert this object into the 3 int list used by macro_value in SQLITE db."""
         return [self.key.to_int(), self.value_2, self.value_3]
 
 
+# CSS class for each unified-diff line, keyed by its first character
+_DIFF_LINE_CLASSES = {'+': 'add', '-': 'del', '@': 'hunk'}
+
+def unified_diff_to_html(diff_lines, title='diff'):
+    """
+    Render the lines of an already-computed `difflib.unified_diff` as a standalone HTML page.
+
+    Unlike `difflib.HtmlDiff`, this does no diffing of its own, so it is linear in the
+    size of the diff.
+    """
+    rows = []
+    for line in diff_lines:
+        css_class = 'file' if line[:3] in ('---', '+++') else _DIFF_LINE_CLASSES.get(line[:1], 'ctx')
+        rows.append(f'<span class="{css_class}">{html.escape(line)}</span>')
+    body = '\n'.join(rows)
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<style>
+  pre {{font-family: monospace; line-height: 1.3}}
+  .file {{font-weight: bold}}
+  .hunk {{color: #6f42c1; background: #f1f8ff}}
+  .add {{background: #aaffaa}}
+  .del {{background: #ffaaaa}}
+</style>
+</head>
+<body>
+<pre>
+{body}
+</pre>
+</body>
+</html>
+'''
+
 def main(db_path, macro_name, dry_run=False):
     """
     """
     tmp_db_dir = tempfile.mkdtemp(prefix=str(db_path).replace(os.path.sep, '_') + '-')
     tmp_db_path = os.path.join(tmp_db_dir, os.path.basename(db_path))
-    shutil.copyfile(db_path, tmp_db_path)
+    # Use SQLite's online backup API rather than a raw file copy, so we get a consistent
+    # snapshot even if ObinsKit has the db open (and pick up any pending WAL content).
+    src_connection = sqlite3.connect(f"{pathlib.Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    tmp_connection = sqlite3.connect(tmp_db_path)
+    src_connection.backup(tmp_connection)
+    src_connection.close()
+    tmp_connection.close()
     logger.debug(f"Copied SQLITE db at path '{db_path}' to temp path '{tmp_db_path}'.")
     logger.debug(f"Connecting to SQLITE db at path '{tmp_db_path}'...")
     connection = sqlite3.connect(tmp_db_path)
+    # Skip fsyncs on this connection; the temp copy can be regenerated from the original.
+    # Don't touch journal_mode: it persists in the header of WAL dbs, and this copy may
+    # end up replacing the user's db.
+    connection.execute("PRAGMA synchronous=OFF")
     logger.debug(f"Getting a cursor from SQLITE db connection...")
     cursor = connection.cursor()
-    # could LIMIT cmd to only SELECT 1, but let's assert instead
-    cmd = f"SELECT macro_value FROM kbd_macro_new WHERE name='{macro_name}'"
-    logger.debug(f"SELECTing macro_value with command {cmd}")
-    cursor.execute(cmd)
+    # could LIMIT cmd to only SELECT 1, but let's check instead
+    cmd = "SELECT macro_value FROM kbd_macro_new WHERE name=?"
+    logger.debug(f"SELECTing macro_value with command {cmd} (name='{macro_name}')")
+    cursor.execute(cmd, (macro_name,))
     selections = cursor.fetchall()
-    assert len(selections) == 1, (
-        f"{len(selections)} rows were SELECTed by cmd '{cmd}'."
-        f" There must be exactly one selected row."
-        f" Check your SELECT command.")
+    if len(selections) != 1:
+        raise ValueError(
+            f"{len(selections)} rows were SELECTed by cmd '{cmd}' (name='{macro_name}')."
+            f" There must be exactly one selected row."
+            f" Check your SELECT command.")
     logger.debug(f'There are {len(selections)} items returned by cursor.fetch_all:\n{selections}')
-    macro_value = selections[0][0].strip('[]').split(',')
-    int_macro_value = [int(x) for x in macro_value]
-    int_3_tuples = [tuple(int_macro_value[i:i+3]) for i in range(0, len(int_macro_value), 3)]
+    int_macro_value = json.loads(selections[0][0])
+    if not isinstance(int_macro_value, list) or len(int_macro_value) % 3 != 0:
+        raise ValueError(
+            f"macro_value of macro '{macro_name}' is not a list of 3-int macro events:"
+            f" {selections[0][0]}")
+    int_3_tuples = list(zip(*[iter(int_macro_value)] * 3))
     logger.debug(f'There are {len(int_3_tuples)} 3-tuples in our modified macro_value list:\n{int_3_tuples}')
+    old_tuples = [ObinsKitMacroItemTuple(_BY_INT[k], v2, v3) for k, v2, v3 in int_3_tuples]
     fd, temppath = tempfile.mkstemp(text=True)
     with os.fdopen(fd, 'w') as f:
         logger.debug(f"Writing instructions to header in temp file {temppath}...")
@@ -170,27 +243,35 @@ f'''# INSTRUCTIONS FOR EDITING THIS OBINSKIT MACRO
 #   WAIT     10
 #   KEY_UP   J
 '''
-        f.write(instructions)
         logger.debug(f"Dumping macro events to temporary file {temppath} for editing...")
-        for i,t in enumerate(map(ObinsKitMacroItemTuple._make, int_3_tuples)):
-            logger.debug(f"{i:3}: {t}")
-            f.write(f"{t}\n")
-    logger.debug(f"Opening temp file in $EDITOR: {os.environ['EDITOR']}...")
-    cmd = f"{os.environ['EDITOR']} {temppath}"
-    completed_process = subprocess.run(cmd, shell=True)
+        old_strings = list(map(str, old_tuples))
+        for i,t in enumerate(old_strings):
+            logger.debug("%3d: %s", i, t)
+        original_body = "\n".join(old_strings) + "\n"
+        # One write for header and events, rather than one per line
+        f.write(instructions + original_body)
+    editor = os.environ.get('EDITOR') or 'vi'
+    logger.debug(f"Opening temp file in $EDITOR: {editor}...")
+    try:
+        completed_process = subprocess.run([*shlex.split(editor), temppath])
+    except OSError as e:
+        logger.error(f"{editor} process could not be started: {e}!")
+        sys.exit(127)
     logger.debug(f"Return code: {completed_process.returncode}")
     if completed_process.returncode != 0:
-        logger.error(f"{os.environ['EDITOR']} process returned error: {completed_process.returncode}!")
+        logger.error(f"{editor} process returned error: {completed_process.returncode}!")
         sys.exit(completed_process.returncode)
     # On successful return code, validate file (stripping comments and whitespace-only lines)
     # and re-encode macro_value and UPDATE table
     with open(temppath, 'r') as f:
-        lines = [line for line in f.readlines() if (not line.startswith('#') and not line.isspace())]
+        lines = [line for line in f if line[:1] != '#' and not line.isspace()]
     logger.debug(f"lines:\n{''.join(lines)}")
-    new_macro_value = []
-    for line in lines:
-        macro_tuple_for_line = ObinsKitMacroItemTuple.from_str(line)
-        new_macro_value += macro_tuple_for_line.to_int_macro_value_list()
+    # Cheap text comparison first, so an unmodified file is never re-parsed or diffed
+    if ''.join(lines) == original_body:
+        logger.info("Macro text not changed, nothing to update. Exiting..")
+        sys.exit(0)
+    new_tuples = [ObinsKitMacroItemTuple.from_str(line) for line in lines]
+    new_macro_value = [v for t in new_tuples for v in t.to_int_macro_value_list()]
     logger.debug(f"new_macro_value: {new_macro_value}")
     logger.debug(f"old_macro_value: {int_macro_value}")
     if new_macro_value == int_macro_value:
@@ -202,14 +283,15 @@ f'''# INSTRUCTIONS FOR EDITING THIS OBINSKIT MACRO
     # logger.debug(f"Difference between old and new macro_values is:\n{difference}")
     # symmetrical_difference = list(set(macro_value).symmetric_difference(set(new_macro_value)))
     # logger.debug(f"Symmetrical Difference between old and new macro_values is:\n{symmetrical_difference}")
-    old_strings = [f"{t}" for t in int_3_tuples]
-    new_int_3_tuples = [tuple(new_macro_value[i:i+3]) for i in range(0, len(new_macro_value), 3)]
-    new_strings = [f"{t}" for t in new_int_3_tuples]
+    new_strings = list(map(str, new_tuples))
+    import difflib
     t0 = time.time()
-    result = list(difflib.unified_diff(new_strings, old_strings, lineterm=''))
-    logger.debug(f"Text unified-diff between old and new macro_values (took {time.time()-t0}s):\n{pprint.pformat(result)}")
+    result = list(difflib.unified_diff(old_strings, new_strings, fromfile='old macro_values', tofile='new macro_values', n=5, lineterm=''))
+    if logger.isEnabledFor(logging.DEBUG):
+        import pprint
+        logger.debug(f"Text unified-diff between old and new macro_values (took {time.time()-t0}s):\n{pprint.pformat(result)}")
     t0 = time.time()
-    html_str = difflib.HtmlDiff().make_file(old_strings, new_strings, fromdesc='old macro_values', todesc='new macro_values', context=True, numlines=5)
+    html_str = unified_diff_to_html(result, title=f"{macro_name} macro_values diff")
     html_dir = tempfile.mkdtemp()
     html_file_path = os.path.join(html_dir, 'index.html')
     with open(html_file_path, 'w') as f:
@@ -232,12 +314,11 @@ f'''# INSTRUCTIONS FOR EDITING THIS OBINSKIT MACRO
     # rely on user to manage browser process(es), i.e. do not terminate
 
     # UPDATE the macro_value column in the macro_name row in the kbd_macro_new table.
-    cmd = f"UPDATE kbd_macro_new SET macro_value='{new_macro_value}' WHERE name='{macro_name}'"
-    logger.debug(f"UPDATEing macro_value with command {cmd}")
-    cursor.execute(cmd)
-
-    # Commit any pending transaction to the database and close connection to it
-    connection.commit()
+    # The connection context manager commits on success and rolls back on error.
+    cmd = "UPDATE kbd_macro_new SET macro_value=? WHERE name=?"
+    logger.debug(f"UPDATEing macro_value with command {cmd} (macro_value='{new_macro_value}', name='{macro_name}')")
+    with connection:
+        cursor.execute(cmd, (str(new_macro_value), macro_name))
     connection.close()
     logger.debug(f"Committed SQLITE transactions and closed connection.")
 
@@ -284,6 +365,7 @@ if __name__ == '__main__':
 
     logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
     if args.list_keycodes:
+        import pprint
         print("\nkeycodes_by_value:")
         pprint.pprint(keycodes_by_value)
         print("\nkeycodes_by_name:")
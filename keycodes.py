@@ -23,6 +23,10 @@ We transform `originalMap` into more useful representations of the data, maps
 keyed by name and value, repectively:
   1. `keycodes_by_value`, which optimizes lookups using the integer keycode and
   2. `keycodes_by_name`, which optimizes lookups using the string name.
+For hot paths that only need the name or the value, there are also
+flat tables:
+  1. `NAME_BY_VALUE`, a 256-slot list indexed by integer keycode (None if unused) and
+  2. `VALUE_BY_NAME`, a dict of string name to integer keycode.
 
 Nota Bene:
     * "value" in this context is the integer that appears in macro_value
@@ -155,3 +159,7 @@ keycodes_by_value = {
 keycodes_by_name = {
     _dict["name"]: {"id": _id, "value": _dict["value"]} for _id, _dict in originalMap
 }
+NAME_BY_VALUE = [None] * 256
+for _id, _dict in originalMap:
+    NAME_BY_VALUE[_dict["value"]] = _dict["name"]
+VALUE_BY_NAME = {_dict["name"]: _dict["value"] for _id, _dict in originalMap}